@@ -0,0 +1,108 @@
+"""
+Module contains an in-memory cache for answers of the RAG System.
+
+Author: Ivan Khrop
+Date: 17.10.2026
+"""
+
+from collections import OrderedDict
+from typing import Any
+import threading
+import time
+
+
+def normalize_query(query: str) -> str:
+    """
+    Bring a query to a canonical form: lower case, single spaces, no trailing "?", "!" or ".".
+
+    Other punctuation is kept, it can change the meaning (e.g. "-5" and "5", "C++" and "C").
+    """
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+class AnswerCache:
+    """
+    LRU cache with TTL for answers of the RAG System.
+
+    A query is matched exactly on its normalized text. Similar but different queries are not
+    matched, because one changed token (e.g. "pump 3" and "pump 4") can change the answer.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600.0):
+        """
+        Create an empty cache.
+
+        Parameters
+        ----------
+        max_size: int
+            Maximal amount of stored answers, least recently used ones are evicted first.
+        ttl: float
+            Lifetime of an answer in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        # increased by every clear, answers computed before a clear are not stored
+        self.generation = 0
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+    def _drop_expired(self, now: float) -> None:
+        """Remove entries that are older than TTL. Must be called under the lock."""
+        expired = [key for key, (created, _) in self._entries.items() if now - created > self.ttl]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, query: str) -> Any | None:
+        """Return the cached answer for a query or None."""
+        key = normalize_query(query)
+        now = time.monotonic()
+
+        with self._lock:
+            self._drop_expired(now)
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][1]
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, value: Any, generation: int | None = None) -> None:
+        """
+        Save the answer for a query.
+
+        If generation is given, the answer is dropped when the cache was cleared since then.
+        """
+        key = normalize_query(query)
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop all answers, e.g. when new documents were indexed."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def stats(self) -> dict[str, int]:
+        """Return counters of the cache."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
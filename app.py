@@ -4,22 +4,19 @@ Module contains the WebApp for using RAG ChatBot.
 Author: Ivan Khrop
 Date: 08.04.2025
 """
+
+# run streamlit run app.py in the terminal, uploaded documents are indexed only while
+# python ingestion_queue.py --workers 2 is running as well
+
 # basic imports
 import streamlit as st
 import os
 import logging
-import torch
-
-# custom imports
-from src.query_processing import reply_query
-from src.metadata import MetaData
-from src.document_storage import (
-    add_document,
-    index_document,
-    retrieve_reference,
-    index_tabular_document,
-)
+
+# custom imports, modules of RAG System are loaded lazily by load_models
 from streamlit_pdf_viewer import pdf_viewer
+from reference_cache import ReferenceCache
+from ingestion_queue import IngestionQueue
 
 # configure logging
 logging.basicConfig(
@@ -29,8 +26,18 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-# initialize torch to prevent path error
-torch.classes.__path__ = [os.path.join(torch.__path__[0], torch.classes.__file__)]
+
+@st.cache_resource(show_spinner="Loading models ...")
+def load_models() -> None:
+    """Import modules of RAG System once per process, all sessions share them."""
+    import torch
+    import src.query_processing  # noqa: F401
+    import src.document_storage  # noqa: F401
+    import src.vector_db  # noqa: F401
+    import src.metadata  # noqa: F401
+
+    # initialize torch to prevent path error
+    torch.classes.__path__ = [os.path.join(torch.__path__[0], torch.classes.__file__)]
 
 
 # create session state variables
@@ -54,6 +61,48 @@ def drop_state():
     st.session_state.messages = list()
 
 
+@st.cache_resource
+def get_ingestion_queue() -> IngestionQueue:
+    """Open the queue of indexing jobs, workers are started with ingestion_queue.py."""
+    return IngestionQueue()
+
+
+@st.cache_resource
+def get_reference_cache() -> ReferenceCache:
+    """Create one cache of rendered references shared by all sessions."""
+    max_megabytes = int(os.environ.get("REFERENCE_CACHE_MB", default="256"))
+    return ReferenceCache(max_bytes=max_megabytes * 1024 * 1024)
+
+
+@st.cache_resource
+def get_reference_cache_state() -> dict[str, float]:
+    """Remember the latest finished indexing job that the reference cache already includes."""
+    return {"finished_at": get_ingestion_queue().last_finished()}
+
+
+def load_reference(doc_name: str, page_from: int, page_to: int) -> bytes | None:
+    """Return rendered pages of a document, use the cache if they were rendered before."""
+    from src.document_storage import retrieve_reference
+
+    cache = get_reference_cache()
+
+    # documents could be replaced by a finished indexing job, so cached pages are outdated
+    last_finished = get_ingestion_queue().last_finished()
+    state = get_reference_cache_state()
+    if last_finished > state["finished_at"]:
+        state["finished_at"] = last_finished
+        cache.clear()
+
+    cached = cache.get(doc_name=doc_name, page_from=page_from, page_to=page_to)
+    if cached is not None:
+        return cached[0]
+
+    content = retrieve_reference(doc_name=doc_name, page_from=page_from, page_to=page_to)
+    if content is not None:
+        cache.put(doc_name=doc_name, page_from=page_from, page_to=page_to, content=content)
+    return content
+
+
 # set the title and some initial information
 st.set_page_config(layout="wide")
 st.title("RAG PoC Application")
@@ -106,6 +155,12 @@ def main():
 
     # show interface to a user
     else:
+        # sign in page does not need models, so they are loaded only now
+        load_models()
+        from src.query_processing import reply_query
+        from src.metadata import MetaData
+        from src.vector_db import check_document_existance
+
         # sidebar navigation
         st.sidebar.title("Navigation")
         page = st.sidebar.radio("Go to", ["RAG Chat", "Update Database"])
@@ -138,7 +193,7 @@ def main():
                             # get the selected and create reference
                             idx = selection_event.selection.rows[0]
 
-                            reference = retrieve_reference(
+                            reference = load_reference(
                                 doc_name=message["references"].iloc[idx]["Document"],
                                 page_from=int(message["references"].iloc[idx]["Page From"]),
                                 page_to=int(message["references"].iloc[idx]["Page To"]),
@@ -196,27 +251,66 @@ def main():
             )
             comment = st.text_input("Add a comment for uploading files", value="")
 
+            # matches by name only, so edited or partly indexed documents would be skipped too
+            skip_existing = st.checkbox(
+                "Skip documents with the same name that are already indexed", value=False
+            )
+
             if uploaded_files and st.button("Update Database"):
-                # iterate through the uploaded files and try to incorporate them in Vector Database
+                queue = get_ingestion_queue()
+
+                # skip what is already in Vector Database and queue the rest for indexing
+                n_queued = 0
                 for uploaded_file in uploaded_files:
-                    # save the document
-                    add_document(name=uploaded_file.name, content=uploaded_file.getbuffer())
-
-                    # add the document to Database depending on the format
-                    if uploaded_file.name.endswith(".xlsx"):
-                        index_tabular_document(
-                            content=uploaded_file.getbuffer(),
-                            doc_name=uploaded_file.name,
-                            author=st.session_state.user_login,
-                            comment=comment,
-                        )
-                    else:
-                        index_document(
-                            content=uploaded_file.getbuffer(),
-                            doc_name=uploaded_file.name,
-                            author=st.session_state.user_login,
-                            comment=comment,
-                        )
+                    if skip_existing and check_document_existance(doc_name=uploaded_file.name):
+                        continue
+
+                    job_id = queue.submit(
+                        doc_name=uploaded_file.name,
+                        content=bytes(uploaded_file.getbuffer()),
+                        author=st.session_state.user_login,
+                        comment=comment,
+                    )
+                    logging.info(msg=f"Document {uploaded_file.name} is queued as job {job_id}.")
+                    n_queued += 1
+
+                if n_queued < len(uploaded_files):
+                    st.info(f"Skipped {len(uploaded_files) - n_queued} already indexed documents.")
+                st.success(f"{n_queued} documents are queued for indexing.")
+
+            # show the latest indexing jobs of the user, the button only reruns the page
+            st.subheader("Indexing Jobs")
+            st.button("Refresh")
+
+            # warn when uploads can not be processed
+            queue = get_ingestion_queue()
+            stall_warning = int(os.environ.get("INGESTION_STALL_SECONDS", default="600"))
+            if queue.alive_workers() == 0:
+                st.warning(
+                    "No indexing worker is running, uploaded documents stay queued. "
+                    "Start workers with `python ingestion_queue.py --workers 2`."
+                )
+            elif queue.stalled_for() > stall_warning:
+                st.warning(
+                    f"No indexing job was started or finished for more than "
+                    f"{stall_warning // 60} minutes, check the indexing workers."
+                )
+
+            jobs = queue.get_jobs(author=st.session_state.user_login, limit=20)
+            if jobs:
+                st.dataframe(
+                    [
+                        {
+                            "Job": job["id"],
+                            "Document": job["doc_name"],
+                            "Status": job["status"],
+                            "Stage": job["stage"],
+                            "Error": job["error"] or "",
+                        }
+                        for job in jobs
+                    ],
+                    hide_index=True,
+                )
 
 
 # run main function
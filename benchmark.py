@@ -0,0 +1,300 @@
+"""
+Module contains a latency and throughput benchmark for the RAG server and the Azure proxy.
+
+Author: Ivan Khrop
+Date: 17.10.2026
+"""
+
+# examples:
+#   python benchmark.py query --url http://localhost:8100 --concurrency 8 --requests 200
+#   (caches of the server are bypassed unless --use-cache is given)
+#   python benchmark.py document --url http://localhost:8100 --doc-name manual.pdf
+#   python benchmark.py fake-azure --port 8600  (set BASE_ENDPOINT_URL=http://localhost:8600)
+#   python benchmark.py proxy --url http://localhost:8500 --stream
+
+from typing import Any, Awaitable, Callable
+import argparse
+import asyncio
+import json
+import time
+import re
+
+import httpx
+
+DEFAULT_QUERIES = [
+    "What is Retrieval-Augmented Generation?",
+    "How do I reset the device to factory settings?",
+    "Which safety instructions apply to maintenance?",
+    "Wie wird das Gerät gereinigt?",
+    "Quelles sont les caractéristiques techniques ?",
+]
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Return the q-th percentile (0-100) of values using the nearest rank."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(int(round(q / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def peak_rss_mb(pid: int | None) -> float | None:
+    """Return peak resident memory in MB of the server process, None if it is unknown."""
+    if pid is None:
+        return None
+
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            match = re.search(r"VmHWM:\s+(\d+) kB", file.read())
+        return int(match.group(1)) / 1024 if match else None
+    except OSError:
+        return None
+
+
+def parse_stage_metrics(text: str) -> dict[str, tuple[float, int]]:
+    """Read sum and count of rag_stage_duration_seconds per stage from /metrics output."""
+    stages: dict[str, tuple[float, int]] = dict()
+    for name, stage, value in re.findall(
+        r'rag_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)', text
+    ):
+        total, count = stages.get(stage, (0.0, 0))
+        if name == "sum":
+            stages[stage] = (float(value), count)
+        else:
+            stages[stage] = (total, int(float(value)))
+    return stages
+
+
+async def read_stage_metrics(client: httpx.AsyncClient, url: str) -> dict[str, tuple[float, int]]:
+    """Get stage timings from the server, empty if /metrics is not available."""
+    try:
+        response = await client.get(f"{url}/metrics")
+        response.raise_for_status()
+        return parse_stage_metrics(response.text)
+    except httpx.HTTPError:
+        return dict()
+
+
+async def run_load(
+    send: Callable[[int], Awaitable[tuple[int, float | None]]], n_requests: int, concurrency: int
+) -> dict[str, Any]:
+    """
+    Send n_requests with the given concurrency and collect statistics.
+
+    Parameters
+    ----------
+    send: Callable[[int], Awaitable[tuple[int, float | None]]]
+        Sends request number i and returns the status code and time to first byte (or None).
+    n_requests: int
+        Total amount of requests.
+    concurrency: int
+        Amount of requests sent at the same time.
+
+    Returns
+    -------
+    dict[str, Any]
+        Latency percentiles in seconds, QPS and status codes.
+    """
+    latencies: list[float] = list()
+    first_bytes: list[float] = list()
+    statuses: dict[str, int] = dict()
+    counter = iter(range(n_requests))
+
+    async def worker() -> None:
+        """Send requests one after another until all are sent."""
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                status, first_byte = await send(i)
+            except httpx.HTTPError as e:
+                status, first_byte = type(e).__name__, None
+            latencies.append(time.perf_counter() - start)
+            if first_byte is not None:
+                first_bytes.append(first_byte)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+
+    result = {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "duration_s": duration,
+        "qps": n_requests / duration,
+        "latency_s": {f"p{q}": percentile(latencies, q) for q in (50, 95, 99)},
+        "status_codes": statuses,
+    }
+    if first_bytes:
+        result["time_to_first_byte_s"] = {f"p{q}": percentile(first_bytes, q) for q in (50, 95, 99)}
+    return result
+
+
+async def benchmark_server(args: argparse.Namespace) -> dict[str, Any]:
+    """Benchmark /query or /document of the RAG server."""
+    queries = DEFAULT_QUERIES
+    if args.mode == "query" and args.queries:
+        with open(args.queries, encoding="utf-8") as file:
+            queries = [line.strip() for line in file if line.strip()]
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        if args.clear_cache:
+            await client.delete(f"{args.url}/cache")
+        stages_before = await read_stage_metrics(client, args.url)
+
+        # without the caches the run measures reply_query and retrieve_reference
+        no_cache = not args.use_cache
+        n_cache_hits = 0
+
+        async def send(i: int) -> tuple[int, float | None]:
+            """Send one request to the selected endpoint."""
+            nonlocal n_cache_hits
+            if args.mode == "query":
+                response = await client.post(
+                    f"{args.url}/query",
+                    json={"query": queries[i % len(queries)], "no_cache": no_cache},
+                )
+            else:
+                response = await client.get(
+                    f"{args.url}/document",
+                    params={
+                        "doc_name": args.doc_name,
+                        "page_from": args.page_from,
+                        "page_to": args.page_to,
+                        "no_cache": no_cache,
+                    },
+                )
+            if response.headers.get("x-cache") == "hit":
+                n_cache_hits += 1
+            return response.status_code, None
+
+        result = await run_load(send, n_requests=args.requests, concurrency=args.concurrency)
+        result["cache_hits"] = n_cache_hits
+        stages_after = await read_stage_metrics(client, args.url)
+
+    # mean duration of every stage during the run
+    result["stages_mean_s"] = dict()
+    for stage, (total, count) in stages_after.items():
+        total_before, count_before = stages_before.get(stage, (0.0, 0))
+        if count > count_before:
+            result["stages_mean_s"][stage] = (total - total_before) / (count - count_before)
+
+    return result
+
+
+async def benchmark_proxy(args: argparse.Namespace) -> dict[str, Any]:
+    """Benchmark /v1/chat/completions of the Azure proxy."""
+    body = {
+        "messages": [{"role": "user", "content": "Describe the benchmark."}],
+        "stream": args.stream,
+    }
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+
+        async def send(i: int) -> tuple[int, float | None]:
+            """Send one chat completion and measure the time to the first chunk."""
+            start = time.perf_counter()
+            first_byte = None
+            async with client.stream("POST", f"{args.url}/v1/chat/completions", json=body) as r:
+                async for _ in r.aiter_bytes():
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - start
+            return r.status_code, first_byte
+
+        return await run_load(send, n_requests=args.requests, concurrency=args.concurrency)
+
+
+def run_fake_azure(args: argparse.Namespace) -> None:
+    """Run a deterministic stand-in for the Azure chat completion endpoint."""
+    import uvicorn
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    tokens = [f"token{i} " for i in range(args.n_tokens)]
+
+    @app.post("/{path:path}")
+    async def complete(path: str, request: Request):
+        """Answer with fixed tokens after a fixed delay."""
+        body = await request.json()
+        await asyncio.sleep(args.latency)
+
+        if not body.get("stream", False):
+            await asyncio.sleep(args.token_latency * len(tokens))
+            message = {"role": "assistant", "content": "".join(tokens)}
+            return {"object": "chat.completion", "choices": [{"index": 0, "message": message}]}
+
+        async def events():
+            """Send one server-sent event per token."""
+            for token in tokens:
+                await asyncio.sleep(args.token_latency)
+                delta = {"delta": {"content": token}}
+                chunk = {"object": "chat.completion.chunk", "choices": [delta]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
+
+
+def main() -> None:
+    """Parse arguments, run the selected benchmark and save the result as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    for mode in ("query", "document", "proxy"):
+        sub = subparsers.add_parser(mode)
+        sub.add_argument("--url", default="http://localhost:8100")
+        sub.add_argument("--concurrency", type=int, default=4)
+        sub.add_argument("--requests", type=int, default=100)
+        sub.add_argument("--timeout", type=float, default=300.0)
+        sub.add_argument("--output", default=f"benchmark_{mode}.json")
+        sub.add_argument(
+            "--server-pid", type=int, default=None, help="PID of the server to report peak RSS"
+        )
+
+        if mode in ("query", "document"):
+            sub.add_argument(
+                "--use-cache", action="store_true", help="Let the server answer from its caches"
+            )
+            sub.add_argument("--clear-cache", action="store_true")
+        if mode == "query":
+            sub.add_argument("--queries", default=None, help="File with one query per line")
+        if mode == "document":
+            sub.add_argument("--doc-name", required=True)
+            sub.add_argument("--page-from", type=int, default=1)
+            sub.add_argument("--page-to", type=int, default=1)
+        if mode == "proxy":
+            sub.add_argument("--stream", action="store_true")
+
+    fake = subparsers.add_parser("fake-azure")
+    fake.add_argument("--port", type=int, default=8600)
+    fake.add_argument("--latency", type=float, default=0.5, help="Seconds before the first token")
+    fake.add_argument("--token-latency", type=float, default=0.02, help="Seconds per token")
+    fake.add_argument("--n-tokens", type=int, default=100)
+
+    args = parser.parse_args()
+
+    if args.mode == "fake-azure":
+        run_fake_azure(args)
+        return
+
+    if args.mode == "proxy":
+        result = asyncio.run(benchmark_proxy(args))
+    else:
+        result = asyncio.run(benchmark_server(args))
+
+    result["mode"] = args.mode
+    result["peak_rss_mb"] = peak_rss_mb(args.server_pid)
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
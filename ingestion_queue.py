@@ -0,0 +1,408 @@
+"""
+Module contains a persistent queue of document indexing jobs and worker processes for it.
+
+Author: Ivan Khrop
+Date: 17.10.2026
+"""
+
+# run python ingestion_queue.py --workers 2 in the terminal to process uploaded documents,
+# without running workers uploads from app.py stay queued
+
+from multiprocessing import Process
+from threading import Thread
+from contextlib import contextmanager
+from typing import Any, Iterator
+import argparse
+import hashlib
+import logging
+import sqlite3
+import time
+import os
+
+INGESTION_DB = os.getenv("INGESTION_DB", "ingestion_jobs.db")
+INGESTION_SPOOL = os.getenv("INGESTION_SPOOL", "ingestion_spool")
+
+# a job whose worker died this many times is marked as failed instead of being queued again
+INGESTION_MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", "3"))
+
+# workers save a heartbeat this often, a worker without one for 3 intervals is seen as dead
+HEARTBEAT_INTERVAL = 10.0
+
+# job states
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class IngestionQueue:
+    """
+    Queue of indexing jobs stored in SQLite, content of documents is kept in a spool folder.
+
+    The same document (name and content) submitted again while it is still waiting or running
+    is not added twice. Workers take jobs of the author with the fewest running jobs first.
+    """
+
+    def __init__(self, db_path: str = INGESTION_DB, spool_dir: str = INGESTION_SPOOL):
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    doc_name TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    author TEXT NOT NULL,
+                    comment TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    error TEXT,
+                    worker_pid INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)"
+            )
+
+            # databases created before attempts were counted
+            columns = [row["name"] for row in connection.execute("PRAGMA table_info(jobs)")]
+            if "attempts" not in columns:
+                connection.execute(
+                    "ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+                )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS workers (pid INTEGER PRIMARY KEY, heartbeat REAL)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection in autocommit mode, transactions are started explicitly."""
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _spool_path(self, content_hash: str) -> str:
+        """Path of the stored content."""
+        return os.path.join(self.spool_dir, content_hash)
+
+    def submit(self, doc_name: str, content: bytes, author: str, comment: str) -> int:
+        """
+        Add a document to the queue.
+
+        Parameters
+        ----------
+        doc_name: str
+            Name of the document, the format is taken from the extension.
+        content: bytes
+            Content of the document.
+        author: str
+            User who uploaded the document.
+        comment: str
+            Comment for the upload.
+
+        Returns
+        -------
+        int
+            Id of the new job or of the equal job that is already waiting or running.
+        """
+        content_hash = hashlib.sha256(content).hexdigest()
+
+        with self._connect() as connection:
+            # spool files are written and removed only under the lock of the database
+            connection.execute("BEGIN IMMEDIATE")
+
+            # write the content first, so a worker never sees a job without its content
+            path = self._spool_path(content_hash)
+            if not os.path.exists(path):
+                with open(path + ".tmp", "wb") as file:
+                    file.write(content)
+                os.replace(path + ".tmp", path)
+
+            row = connection.execute(
+                "SELECT id FROM jobs WHERE doc_name = ? AND content_hash = ? AND status IN (?, ?)",
+                (doc_name, content_hash, QUEUED, RUNNING),
+            ).fetchone()
+            if row is not None:
+                connection.execute("COMMIT")
+                return row["id"]
+
+            cursor = connection.execute(
+                "INSERT INTO jobs (doc_name, content_hash, author, comment, status, stage, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (doc_name, content_hash, author, comment, QUEUED, "waiting", time.time()),
+            )
+            connection.execute("COMMIT")
+            return int(cursor.lastrowid)
+
+    def claim(self, worker_pid: int) -> dict[str, Any] | None:
+        """
+        Take the next job for a worker, the author with the fewest running jobs goes first.
+
+        Jobs of a document that is being indexed by another worker wait until it is finished.
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                """
+                SELECT * FROM jobs AS job WHERE status = ?
+                AND doc_name NOT IN (SELECT doc_name FROM jobs WHERE status = ?)
+                ORDER BY (
+                    SELECT COUNT(*) FROM jobs WHERE author = job.author AND status = ?
+                ), created_at
+                LIMIT 1
+                """,
+                (QUEUED, RUNNING, RUNNING),
+            ).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+
+            connection.execute(
+                "UPDATE jobs SET status = ?, stage = ?, worker_pid = ?, started_at = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (RUNNING, "started", worker_pid, time.time(), row["id"]),
+            )
+            connection.execute("COMMIT")
+            return dict(row)
+
+    def read_content(self, job: dict[str, Any]) -> bytes:
+        """Read the content of the document of a job."""
+        with open(self._spool_path(job["content_hash"]), "rb") as file:
+            return file.read()
+
+    def set_stage(self, job_id: int, stage: str) -> None:
+        """Save the current stage of a running job."""
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET stage = ? WHERE id = ?", (stage, job_id))
+
+    def finish(self, job_id: int, error: str | None = None) -> None:
+        """Mark a job as done or failed and drop its content if no other job needs it."""
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "UPDATE jobs SET status = ?, stage = ?, error = ?, finished_at = ? WHERE id = ?",
+                (FAILED if error else DONE, "finished", error, time.time(), job_id),
+            )
+            row = connection.execute(
+                "SELECT content_hash, (SELECT COUNT(*) FROM jobs AS other "
+                "WHERE other.content_hash = job.content_hash AND other.status IN (?, ?)) AS n "
+                "FROM jobs AS job WHERE id = ?",
+                (QUEUED, RUNNING, job_id),
+            ).fetchone()
+
+            if row is not None and row["n"] == 0:
+                try:
+                    os.remove(self._spool_path(row["content_hash"]))
+                except FileNotFoundError:
+                    pass
+            connection.execute("COMMIT")
+
+    def requeue_orphans(self, max_attempts: int = INGESTION_MAX_ATTEMPTS) -> int:
+        """
+        Put running jobs of workers that do not exist anymore back into the queue.
+
+        Jobs that were already started max_attempts times are marked as failed, e.g. documents
+        that kill their worker every time.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT id, worker_pid, attempts FROM jobs WHERE status = ?", (RUNNING,)
+            ).fetchall()
+
+            orphans = [row for row in rows if not _process_exists(row["worker_pid"])]
+            requeued = [row for row in orphans if row["attempts"] < max_attempts]
+            connection.executemany(
+                "UPDATE jobs SET status = ?, stage = ?, worker_pid = NULL WHERE id = ?",
+                [(QUEUED, "waiting", row["id"]) for row in requeued],
+            )
+
+        for row in orphans:
+            if row["attempts"] >= max_attempts:
+                error = f"Worker died {row['attempts']} times during indexing."
+                logging.warning(msg=f"Job {row['id']} failed: {error}")
+                self.finish(row["id"], error=error)
+        return len(requeued)
+
+    def beat(self, worker_pid: int) -> None:
+        """Save that a worker is alive and forget workers that are silent for an hour."""
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO workers (pid, heartbeat) VALUES (?, ?)", (worker_pid, now)
+            )
+            connection.execute("DELETE FROM workers WHERE heartbeat < ?", (now - 3600,))
+
+    def alive_workers(self, max_age: float = 3 * HEARTBEAT_INTERVAL) -> int:
+        """Return the amount of workers that saved a heartbeat during the last max_age seconds."""
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT COUNT(*) AS n FROM workers WHERE heartbeat >= ?", (time.time() - max_age,)
+            ).fetchone()
+        return row["n"]
+
+    def stalled_for(self) -> float:
+        """
+        Return for how many seconds queued jobs wait while no job was started or finished.
+
+        0 if no job is waiting.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT (SELECT MIN(created_at) FROM jobs WHERE status = ?) AS oldest, "
+                "(SELECT MAX(MAX(COALESCE(started_at, 0), COALESCE(finished_at, 0))) "
+                "FROM jobs) AS moved",
+                (QUEUED,),
+            ).fetchone()
+
+        if row["oldest"] is None:
+            return 0.0
+        return time.time() - max(row["oldest"], row["moved"] or 0.0)
+
+    def last_finished(self) -> float:
+        """Return the time when the latest job was finished, 0 if no job was finished yet."""
+        with self._connect() as connection:
+            row = connection.execute("SELECT MAX(finished_at) AS last FROM jobs").fetchone()
+        return row["last"] or 0.0
+
+    def get_job(self, job_id: int) -> dict[str, Any] | None:
+        """Return a job by its id."""
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_jobs(self, author: str | None = None, limit: int = 50) -> list[dict[str, Any]]:
+        """Return the latest jobs, optionally only of one author."""
+        query, params = "SELECT * FROM jobs", tuple()
+        if author is not None:
+            query, params = query + " WHERE author = ?", (author,)
+
+        with self._connect() as connection:
+            rows = connection.execute(f"{query} ORDER BY id DESC LIMIT ?", (*params, limit))
+            return [dict(row) for row in rows.fetchall()]
+
+
+def _process_exists(pid: int | None) -> bool:
+    """Check if a process with the pid is alive."""
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def index_job(queue: IngestionQueue, job: dict[str, Any]) -> None:
+    """Save a document and add it to Vector Database depending on the format."""
+    from src.document_storage import add_document, index_document, index_tabular_document
+
+    content = queue.read_content(job)
+    doc_name, author, comment = job["doc_name"], job["author"], job["comment"]
+
+    # save the document
+    queue.set_stage(job["id"], "saving")
+    add_document(name=doc_name, content=content)
+
+    # add the document to Database depending on the format
+    queue.set_stage(job["id"], "indexing")
+    if doc_name.endswith(".xlsx"):
+        index_tabular_document(content=content, doc_name=doc_name, author=author, comment=comment)
+    else:
+        index_document(content=content, doc_name=doc_name, author=author, comment=comment)
+
+
+def send_heartbeats(queue: IngestionQueue, worker_pid: int) -> None:
+    """Save heartbeats of a worker, also while it indexes a long document."""
+    while True:
+        try:
+            queue.beat(worker_pid)
+        except sqlite3.Error as e:
+            logging.warning(msg=f"Heartbeat of worker {worker_pid} failed: {e}")
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def run_worker(poll_interval: float = 2.0) -> None:
+    """Process jobs from the queue until the process is stopped."""
+    queue = IngestionQueue()
+    pid = os.getpid()
+    Thread(target=send_heartbeats, args=(queue, pid), daemon=True).start()
+    logging.info(msg=f"Ingestion worker {pid} started.")
+
+    while True:
+        job = queue.claim(worker_pid=pid)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        logging.info(msg=f"Worker {pid} indexes {job['doc_name']} (job {job['id']}).")
+        try:
+            index_job(queue, job)
+            queue.finish(job["id"])
+        except Exception as e:
+            logging.exception(msg=f"Job {job['id']} failed: {e}")
+            queue.finish(job["id"], error=str(e))
+
+
+def start_worker(poll_interval: float) -> Process:
+    """Start one worker process."""
+    worker = Process(target=run_worker, kwargs={"poll_interval": poll_interval}, daemon=True)
+    worker.start()
+    return worker
+
+
+def main() -> None:
+    """Start worker processes for the ingestion queue and restart them when they die."""
+    parser = argparse.ArgumentParser(description="Workers for indexing uploaded documents.")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--check-interval", type=float, default=10.0)
+    args = parser.parse_args()
+
+    queue = IngestionQueue()
+    workers = [start_worker(args.poll_interval) for _ in range(args.workers)]
+
+    try:
+        while True:
+            # is_alive also reaps finished processes, so their pids do not exist afterwards
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logging.warning(
+                        msg=f"Worker {worker.pid} exited with code {worker.exitcode}, restarting."
+                    )
+                    workers[i] = start_worker(args.poll_interval)
+
+            # jobs of workers that were killed are started again
+            n_requeued = queue.requeue_orphans()
+            if n_requeued:
+                logging.info(msg=f"{n_requeued} interrupted jobs are queued again.")
+
+            time.sleep(args.check_interval)
+    except KeyboardInterrupt:
+        logging.info(msg="Stopping ingestion workers.")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    # configure logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format="{asctime} - {levelname} - {message}",
+        style="{",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    main()
@@ -7,8 +7,35 @@ Date: 2025-06-13
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pydantic import Field, BaseModel
 from typing import List, Union, Generator, Iterator, Any, Optional
+from collections import OrderedDict
+import threading
+import time
+
+
+def build_session(max_retries: int) -> requests.Session:
+    """
+    Create a session with keep-alive connections to RAG server.
+
+    Retries with jittered backoff only for failed connections and 502/503, timed out queries
+    may still run on the server.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        read=0,
+        status_forcelist=(502, 503),
+        allowed_methods=None,
+        respect_retry_after_header=True,
+    )
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_maxsize=32, max_retries=retry))
+    session.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=retry))
+    return session
 
 
 class Pipeline:
@@ -20,6 +47,11 @@ class Pipeline:
         pipelines: List[str] = ["*"]
         rag_server_url: str = "http://host.docker.internal"
         rag_server_port: str = "8100"
+        connect_timeout: float = 5.0
+        read_timeout: float = 180.0
+        max_retries: int = 2
+        cache_size: int = 256
+        cache_ttl: float = 600.0
 
     def __init__(self):
         # Optionally, you can set the id and name of the pipeline.
@@ -31,6 +63,25 @@ class Pipeline:
         self.valves = self.Valves()
         self.tools = None
 
+        # session is created on first use with the valves of that moment
+        self.session: requests.Session | None = None
+        self.session_retries: int | None = None
+        self.session_lock = threading.Lock()
+
+        # recent answers per conversation: (chat_id, query) -> (time, answer)
+        self.cache: OrderedDict[tuple[str, str], tuple[float, dict[str, Any]]] = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def _get_session(self) -> requests.Session:
+        """Return the session to RAG server, valves are set after __init__ and may change."""
+        with self.session_lock:
+            if self.session is None or self.session_retries != self.valves.max_retries:
+                if self.session is not None:
+                    self.session.close()
+                self.session = build_session(self.valves.max_retries)
+                self.session_retries = self.valves.max_retries
+            return self.session
+
     def retrieve_from_rag(
         self, query: str = Field(default=None, description="Answer the provided query using RAG.")
     ) -> dict[str, Any]:
@@ -52,7 +103,11 @@ class Pipeline:
         params = {"query": query}
 
         try:
-            response = requests.post(base_url, json=params)
+            response = self._get_session().post(
+                base_url,
+                json=params,
+                timeout=(self.valves.connect_timeout, self.valves.read_timeout),
+            )
             response.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
 
             return response.json()
@@ -60,6 +115,30 @@ class Pipeline:
         except requests.RequestException as e:
             return {"answer": f"Error fetching data: {str(e)}"}
 
+    def retrieve_cached(self, chat_id: str, query: str) -> dict[str, Any]:
+        """Answer the query, reuse the answer if the same query was asked in the chat recently."""
+        key = (chat_id, query.strip())
+        now = time.monotonic()
+
+        # pipes are called from several threads, the request itself runs without the lock
+        with self.cache_lock:
+            cached = self.cache.get(key)
+            if cached is not None and now - cached[0] < self.valves.cache_ttl:
+                self.cache.move_to_end(key)
+                return cached[1]
+
+        answer = self.retrieve_from_rag(query=query)
+
+        # errors are not cached, the next call must try again
+        if "references" in answer:
+            with self.cache_lock:
+                self.cache[key] = (now, answer)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.valves.cache_size:
+                    self.cache.popitem(last=False)
+
+        return answer
+
     async def on_startup(self):
         """Do something when the server is started."""
         # Add you code here
@@ -70,7 +149,8 @@ class Pipeline:
         """Do something when the server is stopped."""
         # Add you code here
         print(f"on_shutdown:{__name__}")
-        pass
+        if self.session is not None:
+            self.session.close()
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         """Apply filter to the form data BEFORE it is sent to the LLM API."""
@@ -107,7 +187,8 @@ class Pipeline:
 
         try:
             # call RAG
-            answer = self.retrieve_from_rag(query=user_message)
+            chat_id = str(body.get("chat_id") or body.get("metadata", {}).get("chat_id") or "")
+            answer = self.retrieve_cached(chat_id=chat_id, query=user_message)
 
             # parse the answer
             text_answer: str = ""
@@ -122,16 +203,15 @@ class Pipeline:
             md_table = ""
             if references and isinstance(references, dict) and len(references) > 0:
                 columns = list(references.keys())
-                num_rows = len(references[columns[0]])
-
-                # Header
-                md_table += "| " + " | ".join(columns) + " |\n"
-                md_table += "| " + " | ".join(["---"] * len(columns)) + " |\n"
-
-                # Rows
-                for i in range(num_rows):
-                    row = [str(references[col].get(str(i), "-")) for col in columns]
-                    md_table += "| " + " | ".join(row) + " |\n"
+                row_ids = list(references[columns[0]].keys())
+
+                # Header, separator and rows are joined once
+                lines = ["| " + " | ".join(columns) + " |", "|" + " --- |" * len(columns)]
+                lines.extend(
+                    "| " + " | ".join(str(references[col].get(i, "-")) for col in columns) + " |"
+                    for i in row_ids
+                )
+                md_table = "\n".join(lines) + "\n"
 
             # return the final string
             if md_table:
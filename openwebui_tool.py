@@ -7,13 +7,38 @@ Date: 2025-06-13
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pydantic import Field, BaseModel
+import threading
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def build_session(max_retries: int) -> requests.Session:
+    """
+    Create a session with keep-alive connections to RAG server.
+
+    Retries with jittered backoff only for failed connections and 502/503, timed out queries
+    may still run on the server.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        read=0,
+        status_forcelist=(502, 503),
+        allowed_methods=None,
+        respect_retry_after_header=True,
+    )
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_maxsize=32, max_retries=retry))
+    session.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=retry))
+    return session
+
+
 class Tools:
     """Tool class which is used inside OpenWebUI as extended functionality."""
 
@@ -29,9 +54,31 @@ class Tools:
         # RAG Server Port
         rag_server_port: str = Field(default=None, description="Port for RAG Server.")
 
+        # Timeouts for RAG Server
+        connect_timeout: float = Field(default=5.0, description="Connect timeout in seconds.")
+        read_timeout: float = Field(default=180.0, description="Read timeout in seconds.")
+
+        # Retries for failed connections and 502/503 responses
+        max_retries: int = Field(default=2, description="Retries of failed calls.")
+
     def __init__(self):
         self.valves = self.Valves()
 
+        # session is created on first use with the valves of that moment
+        self.session: requests.Session | None = None
+        self.session_retries: int | None = None
+        self.session_lock = threading.Lock()
+
+    def _get_session(self) -> requests.Session:
+        """Return the session to RAG server, valves are set after __init__ and may change."""
+        with self.session_lock:
+            if self.session is None or self.session_retries != self.valves.max_retries:
+                if self.session is not None:
+                    self.session.close()
+                self.session = build_session(self.valves.max_retries)
+                self.session_retries = self.valves.max_retries
+            return self.session
+
     # Add your custom tools using pure Python code here, make sure to add type hints and descriptions
     def retrieve_from_rag(
         self, query: str = Field(default=None, description="Answer the provided query using RAG.")
@@ -57,12 +104,17 @@ class Tools:
         params = {"query": query}
 
         try:
-            response = requests.post(base_url, json=params)
+            response = self._get_session().post(
+                base_url,
+                json=params,
+                timeout=(self.valves.connect_timeout, self.valves.read_timeout),
+            )
             response.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
 
-            logger.info(f"Query Result: {response.json()}")
+            result = response.json()
+            logger.info(f"Query Result: {len(response.content)} bytes")
 
-            return response.json()
+            return result
 
         except requests.RequestException as e:
             return f"Error fetching data: {str(e)}"
@@ -8,12 +8,13 @@ Date: 17.06.2025
 # run uvicorn proxy_server:app --host 0.0.0.0 --port 8500 in the terminal
 
 from fastapi import FastAPI, Request
-import requests
-from typing import Any
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+import asyncio
+import httpx
 import os
 
-app = FastAPI()
-
 AZURE_ENDPOINT = os.getenv("BASE_ENDPOINT_URL")
 AZURE_API_KEY = os.getenv("ENDPOINT_API_KEY")
 
@@ -21,6 +22,40 @@ assert AZURE_ENDPOINT is not None and AZURE_API_KEY is not None
 
 AZURE_DEPLOYMENT = "azure-deployed-prod"  # or hardcode
 
+# connection pool and concurrency limits towards Azure
+PROXY_MAX_CONNECTIONS = int(os.getenv("PROXY_MAX_CONNECTIONS", "100"))
+PROXY_MAX_KEEPALIVE = int(os.getenv("PROXY_MAX_KEEPALIVE", "20"))
+PROXY_MAX_CONCURRENCY = int(os.getenv("PROXY_MAX_CONCURRENCY", "64"))
+
+# timeouts in seconds, read timeout is the max pause between two received chunks
+PROXY_CONNECT_TIMEOUT = float(os.getenv("PROXY_CONNECT_TIMEOUT", "10"))
+PROXY_READ_TIMEOUT = float(os.getenv("PROXY_READ_TIMEOUT", "300"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Create one shared keep-alive client for the whole lifetime of the server."""
+    app.state.client = httpx.AsyncClient(
+        headers={
+            "Authorization": f"Bearer {AZURE_API_KEY}",
+            "Content-Type": "application/json",
+            "azureml-model-deployment": AZURE_DEPLOYMENT,
+        },
+        limits=httpx.Limits(
+            max_connections=PROXY_MAX_CONNECTIONS,
+            max_keepalive_connections=PROXY_MAX_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(PROXY_READ_TIMEOUT, connect=PROXY_CONNECT_TIMEOUT),
+    )
+    app.state.semaphore = asyncio.Semaphore(PROXY_MAX_CONCURRENCY)
+
+    yield
+
+    await app.state.client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
 
 @app.get("/v1/models")
 def list_models() -> dict[str, Any]:
@@ -50,11 +85,36 @@ async def proxy_chat(request: Request):
     body.setdefault("presence_penalty", 0.0)
     body["model"] = AZURE_DEPLOYMENT  # Force model name
 
-    headers = {
-        "Authorization": f"Bearer {AZURE_API_KEY}",
-        "Content-Type": "application/json",
-        "azureml-model-deployment": AZURE_DEPLOYMENT,
-    }
+    client: httpx.AsyncClient = request.app.state.client
+    semaphore: asyncio.Semaphore = request.app.state.semaphore
+
+    # simple request: wait for the full completion without blocking the event loop
+    if not body.get("stream", False):
+        async with semaphore:
+            response = await client.post(str(AZURE_ENDPOINT), json=body)
+        return JSONResponse(content=response.json(), status_code=response.status_code)
+
+    # streaming request: forward server-sent events as soon as they arrive
+    await semaphore.acquire()
+    try:
+        upstream = await client.send(
+            client.build_request("POST", str(AZURE_ENDPOINT), json=body), stream=True
+        )
+    except BaseException:
+        semaphore.release()
+        raise
+
+    async def forward_events() -> AsyncIterator[bytes]:
+        """Pass chunks from Azure to the client and free the slot afterwards."""
+        try:
+            async for chunk in upstream.aiter_bytes():
+                yield chunk
+        finally:
+            await upstream.aclose()
+            semaphore.release()
 
-    response = requests.post(str(AZURE_ENDPOINT), json=body, headers=headers)
-    return response.json()
+    return StreamingResponse(
+        forward_events(),
+        status_code=upstream.status_code,
+        media_type=upstream.headers.get("content-type", "text/event-stream"),
+    )
@@ -0,0 +1,76 @@
+"""
+Module contains an in-memory cache for rendered document references.
+
+Author: Ivan Khrop
+Date: 17.10.2026
+"""
+
+from collections import OrderedDict
+import threading
+import hashlib
+
+
+def make_etag(content: bytes) -> str:
+    """Build the ETag of a rendered reference from its content."""
+    return hashlib.sha1(content).hexdigest()
+
+
+class ReferenceCache:
+    """
+    LRU cache of rendered page ranges limited by the total size in bytes.
+
+    Keys are (doc_name, page_from, page_to), values are the rendered content and its ETag.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Create an empty cache.
+
+        Parameters
+        ----------
+        max_bytes: int
+            Maximal total size of stored references, least recently used ones are evicted first.
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+
+        self._entries: OrderedDict[tuple[str, int, int], tuple[bytes, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doc_name: str, page_from: int, page_to: int) -> tuple[bytes, str] | None:
+        """Return the content and ETag of a reference or None."""
+        key = (doc_name, page_from, page_to)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, doc_name: str, page_from: int, page_to: int, content: bytes) -> str:
+        """Save a rendered reference and return its ETag."""
+        content = bytes(content)
+        etag = make_etag(content)
+
+        # references larger than the whole budget are not stored
+        if len(content) > self.max_bytes:
+            return etag
+
+        key = (doc_name, page_from, page_to)
+        with self._lock:
+            if key in self._entries:
+                self.n_bytes -= len(self._entries.pop(key)[0])
+
+            self._entries[key] = (content, etag)
+            self.n_bytes += len(content)
+
+            while self.n_bytes > self.max_bytes:
+                _, (old_content, _) = self._entries.popitem(last=False)
+                self.n_bytes -= len(old_content)
+
+        return etag
+
+    def clear(self) -> None:
+        """Drop all references, e.g. when documents were uploaded again."""
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
@@ -5,15 +5,25 @@ Author: Ivan Khrop
 Date: 15.05.2025
 """
 
-from src.query_processing import reply_query
-from src.document_storage import retrieve_reference
-from src.metadata import MetaData
+from answer_cache import AnswerCache
+from reference_cache import ReferenceCache, make_etag
+from ingestion_queue import IngestionQueue
+from metrics import Counter, Histogram, render_metrics
 
-from fastapi import FastAPI, Response
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, Response
+from langdetect import DetectorFactory, LangDetectException, detect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from collections import deque
+from typing import Any, AsyncIterator
 
+import asyncio
 import logging
+import random
+import time
 import json
+import os
 
 # configure logging
 logging.basicConfig(
@@ -23,56 +33,520 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-app = FastAPI()
+# amount of queries processed at the same time and amount of queries waiting for a worker
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "4"))
+QUERY_QUEUE_SIZE = int(os.getenv("QUERY_QUEUE_SIZE", "16"))
 
+# max time in seconds for one query including the time in the queue
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "120"))
 
-@app.post("/query")
-def query_rag(payload: dict) -> str:
-    """Ask RAG System."""
-    logging.info(msg=payload)
+# query answered at start to load all models before the first user arrives, empty to skip
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "")
 
-    # get query text
-    query = payload.get("query")
+# max amount of queries in one batch request
+QUERY_BATCH_MAX = int(os.getenv("QUERY_BATCH_MAX", "64"))
+
+
+def warm_up() -> None:
+    """Import modules of RAG System and optionally answer a query to load all models."""
+    start = time.perf_counter()
+
+    import src.query_processing  # noqa: F401
+    import src.document_storage  # noqa: F401
+    import src.metadata  # noqa: F401
+
+    if WARMUP_QUERY:
+        from src.query_processing import reply_query
+
+        reply_query(
+            user_query=WARMUP_QUERY,
+            use_refinement=False,
+            n_retrieve=10,
+            n_select=1,
+            reranking_strategy="cross_encoder",
+            min_reranking_score=0.2,
+        )
+
+    logging.info(msg=f"Server is ready after {time.perf_counter() - start:.1f} seconds.")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Create the worker pool for queries, start warm-up and drain the pool on shutdown."""
+    app.state.executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="rag")
+    app.state.n_admitted = 0
+    app.state.admission_waiters = deque()
+
+    # answers cached before the start can not exist, so only later jobs are relevant
+    app.state.ingestion_checked_at = time.monotonic()
+    app.state.ingestion_finished_at = ingestion_queue.last_finished()
+
+    # models are loaded in background, so the server accepts connections right away
+    app.state.warm_up = app.state.executor.submit(warm_up)
+
+    yield
 
-    # log query data
-    logging.info(msg=f"Query Received: {query}")
+    # finish running queries, but do not start the waiting ones, without blocking the loop
+    await asyncio.to_thread(app.state.executor.shutdown, wait=True, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+# refinement mode: "auto" decides per query, "always" and "never" are used for comparison
+QUERY_REFINEMENT = os.getenv("QUERY_REFINEMENT", "auto")
+REFINEMENT_MIN_WORDS = int(os.getenv("REFINEMENT_MIN_WORDS", "5"))
+
+# languages that capitalize every noun, capital letters do not mark keywords there
+NOUN_CAPITALIZING_LANGUAGES = {"de", "lb"}
+
+# make language detection deterministic
+DetectorFactory.seed = 0
+
+# queue of indexing jobs, caches are dropped when a job is finished
+ingestion_queue = IngestionQueue()
+
+# min time in seconds between two checks for finished indexing jobs
+INGESTION_CHECK_INTERVAL = float(os.getenv("INGESTION_CHECK_INTERVAL", "2"))
+
+# cache for answers, dropped when documents are indexed and expired after TTL
+answer_cache = AnswerCache(
+    max_size=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+)
+
+# cache for rendered references, limited by its size in bytes
+reference_cache = ReferenceCache(
+    max_bytes=int(os.getenv("REFERENCE_CACHE_MB", "256")) * 1024 * 1024
+)
+
+# media types of supported documents
+DOCUMENT_MEDIA_TYPES = {
+    ".pdf": "application/pdf",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+# share of requests whose full payload and reply are written to the log
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+# metrics exported on /metrics
+REQUESTS = Counter("rag_requests_total", "Amount of handled HTTP requests.")
+REQUEST_LATENCY = Histogram(
+    "rag_request_duration_seconds",
+    "Latency of HTTP requests until the response headers are sent, streamed bodies are not "
+    "included (see stage query_batch).",
+)
+STAGE_LATENCY = Histogram("rag_stage_duration_seconds", "Latency of query processing stages.")
+CACHE_LOOKUPS = Counter("rag_answer_cache_lookups_total", "Lookups in the answer cache.")
+REFINEMENTS = Counter("rag_query_refinements_total", "Decisions to refine a query with LLM.")
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Count requests and measure their latency per endpoint."""
+    start = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        # use the route template to keep the amount of label values small
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+
+        REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, status=status)
+
+
+def sync_caches_with_ingestion(state: Any) -> None:
+    """Drop cached answers and references if an indexing job was finished since the last check."""
+    now = time.monotonic()
+    if now - state.ingestion_checked_at < INGESTION_CHECK_INTERVAL:
+        return
+    state.ingestion_checked_at = now
+
+    last_finished = ingestion_queue.last_finished()
+    if last_finished > state.ingestion_finished_at:
+        state.ingestion_finished_at = last_finished
+        answer_cache.clear()
+        reference_cache.clear()
+        logging.info(msg="Caches are dropped, new documents were indexed.")
+
+
+def needs_refinement(query: str) -> bool:
+    """
+    Decide whether a query is worth an extra LLM call for refinement.
+
+    Short queries and keyword lists (no sentence structure) are used for retrieval as they are.
+    """
+    if QUERY_REFINEMENT != "auto":
+        return QUERY_REFINEMENT == "always"
+
+    words = query.split()
+    if len(words) < REFINEMENT_MIN_WORDS:
+        return False
+
+    # keyword-like query: no punctuation of a sentence and mostly capitalized or numeric tokens
+    if any(symbol in query for symbol in "?.!,"):
+        return True
+
+    try:
+        language = detect(query)
+    except LangDetectException:
+        language = None
+
+    if language in NOUN_CAPITALIZING_LANGUAGES:
+        n_keywords = sum(1 for word in words if word[0].isdigit())
+    else:
+        n_keywords = sum(1 for word in words if word[0].isupper() or word[0].isdigit())
+    return n_keywords < len(words) / 2
+
+
+def answer_query(query: str, log_payload: bool, use_cache: bool = True) -> dict[str, Any]:
+    """Run RAG System for a query and build the response. Blocking, runs in the worker pool."""
+    from src.query_processing import reply_query
+    from src.metadata import MetaData
+
+    # an answer based on documents that were changed during the query must not be cached
+    cache_generation = answer_cache.generation
+
+    # skip the refinement round trip if it is unlikely to help
+    use_refinement = needs_refinement(query)
+    REFINEMENTS.inc(used=str(use_refinement).lower())
 
     # get response
+    start = time.perf_counter()
     answer, references = reply_query(
         user_query=query,
-        use_refinement=True,
+        use_refinement=use_refinement,
         n_retrieve=100,
         n_select=10,
         reranking_strategy="cross_encoder",
         min_reranking_score=0.2,
     )
+    reply_time = time.perf_counter() - start
+    STAGE_LATENCY.observe(reply_time, stage="reply_query")
 
     # convert metadata to DataFrame
-    df = MetaData.build_df_for_metadatas(references)
+    with STAGE_LATENCY.time(stage="build_references"):
+        df = MetaData.build_df_for_metadatas(references)
 
     # build string to answer
     response = {"answer": answer}
     if len(df) > 0:
         response["references"] = df.to_dict(index=True)
 
-    # log the output
-    logging.info(msg=f"RAG Reply: {json.dumps(response)}")
+    # log a short summary and the full output only for sampled requests
+    logging.info(
+        msg=f"Query Received: length={len(query)} cached=False refined={use_refinement} "
+        f"references={len(df)} reply_time={reply_time:.3f}s"
+    )
+    if log_payload:
+        logging.info(msg=f"RAG Reply: {json.dumps(response)}")
+
+    # save the response only if something was found
+    if use_cache and len(df) > 0:
+        answer_cache.put(query, response, generation=cache_generation)
+
+    return response
+
+
+def admit_queries(state: Any, n_queries: int) -> bool:
+    """Reserve places in the worker queue, fails if all workers are busy and the queue is full."""
+    if state.n_admitted + n_queries > QUERY_WORKERS + QUERY_QUEUE_SIZE:
+        logging.warning(msg=f"{n_queries} queries rejected: server is saturated.")
+        return False
+
+    state.n_admitted += n_queries
+    return True
+
+
+def release_queries(state: Any, n_queries: int) -> None:
+    """Free places in the worker queue and hand them over to waiting batch queries first."""
+    state.n_admitted -= n_queries
+
+    while state.admission_waiters and state.n_admitted < QUERY_WORKERS + QUERY_QUEUE_SIZE:
+        waiter = state.admission_waiters.popleft()
+        if not waiter.done():
+            state.n_admitted += 1
+            waiter.set_result(None)
+
+
+async def wait_for_admission(state: Any) -> None:
+    """Reserve one place in the worker queue, wait until a place is free if needed."""
+    if not state.admission_waiters and state.n_admitted < QUERY_WORKERS + QUERY_QUEUE_SIZE:
+        state.n_admitted += 1
+        return
+
+    waiter = asyncio.get_running_loop().create_future()
+    state.admission_waiters.append(waiter)
+    try:
+        await waiter
+    except asyncio.CancelledError:
+        # the place could be handed over right before the cancellation
+        if waiter.done() and not waiter.cancelled():
+            release_queries(state, n_queries=1)
+        raise
+
+
+async def run_admitted_query(
+    state: Any, query: str, log_payload: bool, use_cache: bool = True
+) -> dict[str, Any]:
+    """
+    Answer an admitted query in the worker pool within the deadline.
+
+    The place of the query is freed only when its worker is done, so a query that is still
+    running after the deadline keeps counting against the limit.
+    """
+    loop = asyncio.get_running_loop()
+    future = state.executor.submit(answer_query, query, log_payload, use_cache)
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(release_queries, state, 1))
+
+    # a query that is still waiting in the queue is dropped when the deadline is over
+    return await asyncio.wait_for(asyncio.wrap_future(future), timeout=QUERY_TIMEOUT)
+
+
+@app.post("/query")
+async def query_rag(payload: dict, request: Request) -> JSONResponse:
+    """
+    Ask RAG System.
+
+    Expects {"query": "..."}, "no_cache": true skips the answer cache, e.g. for benchmarks.
+    The X-Cache header of the response is "hit" if the answer was taken from the cache.
+    """
+    # decide whether this request is logged in full
+    log_payload = random.random() < LOG_SAMPLE_RATE
+    if log_payload:
+        logging.info(msg=payload)
+
+    # get query text
+    query = payload.get("query")
+    if not isinstance(query, str) or not query:
+        return JSONResponse(content={"answer": "There is nothing to response."}, status_code=400)
+
+    # check if the query was answered recently and after the last database update
+    use_cache = not payload.get("no_cache", False)
+    if use_cache:
+        sync_caches_with_ingestion(request.app.state)
+        cached = answer_cache.get(query)
+        CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+        if cached is not None:
+            logging.info(msg=f"Query Received: length={len(query)} cached=True")
+            return JSONResponse(content=cached, headers={"X-Cache": "hit"})
+
+    # reject the query right away if all workers are busy and the queue is full
+    if not admit_queries(request.app.state, n_queries=1):
+        return JSONResponse(
+            content={"answer": "Server is busy, please try again later."},
+            status_code=503,
+            headers={"Retry-After": "5"},
+        )
+
+    try:
+        response = await run_admitted_query(request.app.state, query, log_payload, use_cache)
+    except asyncio.TimeoutError:
+        logging.warning(msg=f"Query timed out after {QUERY_TIMEOUT} seconds.")
+        return JSONResponse(
+            content={"answer": "Answering the query took too long, please try again later."},
+            status_code=504,
+        )
 
     # create a string from response
-    return JSONResponse(content=response)
+    return JSONResponse(content=response, headers={"X-Cache": "miss"})
+
+
+@app.post("/query/batch")
+async def query_rag_batch(payload: dict, request: Request) -> Response:
+    """
+    Ask RAG System several queries at once.
+
+    Expects {"queries": ["...", ...]} and streams one JSON line per query as soon as it is
+    answered: {"index": 0, "query": "...", "answer": "...", "references": {...}}.
+    Queries of a batch are admitted one by one as places in the worker queue become free.
+    Failed queries have an "error" field instead of "answer".
+    """
+    queries = payload.get("queries")
+    if not isinstance(queries, list) or not queries or len(queries) > QUERY_BATCH_MAX:
+        return JSONResponse(
+            content={"error": f"Provide a list of 1 to {QUERY_BATCH_MAX} queries."},
+            status_code=400,
+        )
+    if not all(isinstance(query, str) for query in queries):
+        return JSONResponse(content={"error": "All queries must be strings."}, status_code=400)
+
+    # answer known queries right away
+    sync_caches_with_ingestion(request.app.state)
+    cached = [answer_cache.get(query) if query else None for query in queries]
+    for item in cached:
+        CACHE_LOOKUPS.inc(result="miss" if item is None else "hit")
+
+    n_cached = sum(1 for item in cached if item is not None)
+    logging.info(msg=f"Batch Received: size={len(queries)} cached={n_cached}")
+
+    # one batch keeps at most as many queries in the worker queue as there are workers,
+    # others wait for a free place instead of being rejected
+    batch_slots = asyncio.Semaphore(QUERY_WORKERS)
+
+    async def answer_item(index: int) -> dict[str, Any]:
+        """Answer one query of the batch and never raise."""
+        query = queries[index]
+        if not query:
+            return {"index": index, "query": query, "error": "There is nothing to response."}
+        if cached[index] is not None:
+            return {"index": index, "query": query, **cached[index]}
+
+        try:
+            async with batch_slots:
+                await wait_for_admission(request.app.state)
+                response = await run_admitted_query(request.app.state, query, log_payload=False)
+            return {"index": index, "query": query, **response}
+        except asyncio.TimeoutError:
+            return {"index": index, "query": query, "error": "Answering took too long."}
+        except Exception as e:
+            logging.exception(msg=f"Batch query {index} failed: {e}")
+            return {"index": index, "query": query, "error": str(e)}
+
+    tasks = [asyncio.create_task(answer_item(index)) for index in range(len(queries))]
+
+    async def stream_results() -> AsyncIterator[str]:
+        """Send results in the order they are finished."""
+        try:
+            with STAGE_LATENCY.time(stage="query_batch"):
+                for task in asyncio.as_completed(tasks):
+                    yield json.dumps(await task) + "\n"
+        finally:
+            # client is gone, queued queries do not need to be answered
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@app.get("/jobs")
+def get_jobs(author: str | None = None, limit: int = 50) -> list[dict[str, Any]]:
+    """Get the latest indexing jobs, optionally only of one author."""
+    return ingestion_queue.get_jobs(author=author, limit=limit)
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: int) -> JSONResponse:
+    """Get status and stage of an indexing job."""
+    job = ingestion_queue.get_job(job_id)
+    if job is None:
+        return JSONResponse(content={"error": f"Job {job_id} does not exist."}, status_code=404)
+    return JSONResponse(content=job)
+
+
+@app.get("/ready")
+def get_ready(request: Request) -> JSONResponse:
+    """Report whether models are loaded, returns 503 while warm-up is running or failed."""
+    warm_up_future = request.app.state.warm_up
+    if not warm_up_future.done():
+        return JSONResponse(content={"ready": False}, status_code=503)
+
+    error = warm_up_future.exception()
+    if error is not None:
+        return JSONResponse(content={"ready": False, "error": str(error)}, status_code=503)
+
+    return JSONResponse(content={"ready": True})
+
+
+@app.get("/metrics")
+def get_metrics() -> PlainTextResponse:
+    """Export counters and latency histograms in Prometheus text format."""
+    return PlainTextResponse(
+        content=render_metrics(
+            REQUESTS, REQUEST_LATENCY, STAGE_LATENCY, CACHE_LOOKUPS, REFINEMENTS
+        ),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/cache")
+def get_cache_stats() -> dict[str, int]:
+    """Get hit and miss counters of the answer cache."""
+    return answer_cache.stats()
+
+
+@app.delete("/cache")
+def clear_cache() -> dict[str, int]:
+    """Drop all cached answers and references, e.g. after the database was changed directly."""
+    answer_cache.clear()
+    reference_cache.clear()
+    return answer_cache.stats()
+
+
+def parse_range(range_header: str | None, size: int) -> tuple[int, int] | None:
+    """Parse a single byte range like 'bytes=0-99' or 'bytes=-100'. Returns inclusive bounds."""
+    if range_header is None or not range_header.startswith("bytes="):
+        return None
+
+    start_str, _, end_str = range_header.removeprefix("bytes=").partition("-")
+    try:
+        if start_str == "":
+            start, end = max(size - int(end_str), 0), size - 1
+        else:
+            start, end = int(start_str), min(int(end_str), size - 1) if end_str else size - 1
+    except ValueError:
+        return None
+
+    return (start, end) if start <= end else None
 
 
 @app.get("/document")
-def get_document(doc_name: str, page_from: int, page_to: int) -> Response:
-    """Get document view for a reference."""
-    # return reference
-    content = retrieve_reference(doc_name=doc_name, page_from=page_from, page_to=page_to)
+def get_document(
+    doc_name: str, page_from: int, page_to: int, request: Request, no_cache: bool = False
+) -> Response:
+    """
+    Get document view for a reference.
+
+    no_cache=true renders the reference again without the cache, e.g. for benchmarks.
+    The X-Cache header of the response is "hit" if the reference was taken from the cache.
+    """
+    from src.document_storage import retrieve_reference
+
+    # return reference, cached if it was requested before and after the last database update
+    cached = None
+    if not no_cache:
+        sync_caches_with_ingestion(request.app.state)
+        cached = reference_cache.get(doc_name=doc_name, page_from=page_from, page_to=page_to)
+
+    if cached is not None:
+        content, etag = cached
+    else:
+        with STAGE_LATENCY.time(stage="retrieve_reference"):
+            content = retrieve_reference(doc_name=doc_name, page_from=page_from, page_to=page_to)
+        if content is None:
+            return Response(status_code=404)
+        if no_cache:
+            content, etag = bytes(content), make_etag(bytes(content))
+        else:
+            etag = reference_cache.put(
+                doc_name=doc_name, page_from=page_from, page_to=page_to, content=content
+            )
+
+    # the client already has this version
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private",
+        "X-Cache": "miss" if cached is None else "hit",
+    }
+    if request.headers.get("if-none-match") == f'"{etag}"':
+        return Response(status_code=304, headers=headers)
 
     # return the answer depending on the type
-    if doc_name.endswith(".pdf"):
-        return Response(content=content, media_type="application/pdf")
-    elif doc_name.endswith(".xlsx"):
-        return Response(
-            content=content,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
+    media_type = DOCUMENT_MEDIA_TYPES.get(os.path.splitext(doc_name)[1])
+    if media_type is None:
+        return Response(status_code=415)
+
+    # send only the requested part if the client asks for it
+    byte_range = parse_range(request.headers.get("range"), len(content))
+    if byte_range is None:
+        return Response(content=content, media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+    return Response(
+        content=content[start : end + 1], status_code=206, media_type=media_type, headers=headers
+    )